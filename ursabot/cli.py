@@ -5,31 +5,45 @@
 # license that can be found in the LICENSE_BSD file.
 
 import io
+import os
+import atexit
+import re
+import fnmatch
+import hashlib
 import logging
+import operator
 import warnings
+import functools
 from pathlib import Path
 from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 from buildbot.config import ConfigErrors
 from buildbot.plugins import util
 from buildbot.process.results import Results
 from buildbot.process.results import SUCCESS, WARNINGS, FAILURE, EXCEPTION
-from buildbot.util.logger import Logger
+from buildbot.steps.source import Source
 from dockermap.api import DockerClientWrapper
 from twisted.internet import reactor
+from twisted.python.failure import Failure
 from twisted.python.log import PythonLoggingObserver
 
 from .builders import DockerBuilder
 from .configs import Config, MasterConfig
-from .utils import Matching, Filter, ensure_deferred
-from .docker import ImageCollection
+from .utils import ensure_deferred
 from .master import TestMaster
 
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
-logger_ = Logger()  # twisted's logger
+
+# build results considered successful and the ones to attach to on failure
+_SUCCESS_STATES = frozenset({SUCCESS, WARNINGS})
+_ATTACH_STATES = frozenset({FAILURE, EXCEPTION})
+
+# discards the output of the configuration loading unless verbose is set
+_NULL_SINK = open(os.devnull, 'w')
 
 
 # TODO(kszucs): try to use asyncio reactor with uvloop instead of the default
@@ -48,26 +62,39 @@ class UrsabotConfigErrors(click.ClickException):
             click.echo(click.style(f' - {e}'), err=True)
 
 
-@click.group()
-@click.option('--verbose/--quiet', '-v/-q', default=False, is_flag=True)
-@click.option('--config-path', '-c', default='master.cfg',
-              help='Configuration file path')
-@click.option('--config-variable', '-cv', default='master',
-              help='Variable name in the configuration which must be an '
-                   'instance of MasterConfig')
-@click.pass_context
-def ursabot(ctx, verbose, config_path, config_variable):
-    """CLI for Ursabot continous integration framework based on Buildbot
+class LazyContext(dict):
+    """Context object computing the registered values on first access
 
-    `ursabot` command tries to locate the master.cfg file and it looks for a
-    MasterConfig instance in a variable called `master` by default. This
-    configuration affects the rest of the CLI commands.
+    The groups register the expensive values, like the loaded configuration,
+    so they are only computed if the invoked command needs them. For example
+    `ursabot docker build --help` doesn't load the configuration at all.
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._factories = {}
+
+    def lazy(self, key, factory):
+        self._factories[key] = factory
+
+    def __missing__(self, key):
+        try:
+            factory = self._factories[key]
+        except KeyError:
+            raise KeyError(key)
+        # only drop the factory once it has succeeded, so a failing factory
+        # raises its own error again on the next access
+        value = self[key] = factory()
+        del self._factories[key]
+        return value
+
+
+def _load_master_config(config_path, config_variable, verbose):
     if verbose:
-        logging.getLogger('ursabot').setLevel(logging.INFO)
+        stderr, stdout = io.StringIO(), io.StringIO()
+    else:
+        stderr = stdout = _NULL_SINK
 
-    stderr, stdout = io.StringIO(), io.StringIO()
     try:
         with redirect_stderr(stderr), redirect_stdout(stdout):
             with warnings.catch_warnings(record=True) as catched_warnings:
@@ -92,10 +119,56 @@ def ursabot(ctx, verbose, config_path, config_variable):
             f'MasterConfig'
         )
 
-    ctx.ensure_object(dict)
-    ctx.obj['verbose'] = verbose
-    ctx.obj['config'] = config
-    ctx.obj['config_path'] = Path(config_path)
+    return config
+
+
+@click.group()
+@click.option('--verbose/--quiet', '-v/-q', default=False, is_flag=True)
+@click.option('--config-path', '-c', default='master.cfg',
+              help='Configuration file path')
+@click.option('--config-variable', '-cv', default='master',
+              help='Variable name in the configuration which must be an '
+                   'instance of MasterConfig')
+@click.pass_context
+def ursabot(ctx, verbose, config_path, config_variable):
+    """CLI for Ursabot continous integration framework based on Buildbot
+
+    `ursabot` command tries to locate the master.cfg file and it looks for a
+    MasterConfig instance in a variable called `master` by default. This
+    configuration affects the rest of the CLI commands.
+
+    The configuration is only loaded once a command requires it.
+    """
+    if verbose:
+        logging.getLogger('ursabot').setLevel(logging.INFO)
+
+    # wrap the object passed by the caller, e.g. obj={}, to keep its values
+    if not isinstance(ctx.obj, LazyContext):
+        ctx.obj = LazyContext(ctx.obj or {})
+    obj = ctx.obj
+    obj['verbose'] = verbose
+    obj['config_path'] = Path(config_path)
+    obj.lazy('config', lambda: _load_master_config(
+        config_path, config_variable=config_variable, verbose=verbose
+    ))
+
+
+def _select_project(config, name):
+    # the common case, master config with a single project
+    if name is None and len(config.projects) == 1:
+        return config.projects[0]
+
+    if name is None:
+        message = 'Master config has multiple projects, one must be selected'
+    else:
+        try:
+            return config.project(name=name)
+        except KeyError:
+            message = f'Invalid project name {name}, possible values are'
+
+    # only format the project names on error
+    project_names = ', '.join(p.name for p in config.projects)
+    raise click.UsageError(f'{message}: {project_names}')
 
 
 @ursabot.group()
@@ -109,66 +182,40 @@ def project(obj, project):
     Retrieves the selected project's configurations, the project's name must be
     explicitly passed if the master is configured with multiple projects.
     """
-    config = obj['config']
-    project_names = ', '.join(p.name for p in config.projects)
-
-    if project is None:
-        if len(config.projects) == 1:
-            project = config.projects[0]
-        else:
-            raise click.UsageError(f'Master config has multiple projects, one '
-                                   f'must be selected: {project_names}')
-    else:
-        try:
-            project = config.project(name=project)
-        except KeyError:
-            raise click.UsageError(f'Invalid project name {project}, possible '
-                                   f'values are: {project_names}')
-
-    obj['project'] = project
+    obj.lazy('project', lambda: _select_project(obj['config'], project))
 
 
 @ursabot.command('desc')
 @click.pass_obj
 def master_desc(obj):
     """Describe the master configuration"""
-
-    def ul(values):
-        return '\n'.join(f' - {v}' for v in values)
-
     config = obj['config']
-
-    click.echo('Docker images:')
-    click.echo(ul(i.fqn for i in config.images))
-    click.echo()
-    click.echo('Workers:')
-    click.echo(ul(config.workers))
-    click.echo()
-    click.echo('Builders:')
-    click.echo(ul(b.name for b in config.builders))
-    click.echo()
+    click.echo(_describe(config), nl=False)
 
 
 @project.command('desc')
 @click.pass_obj
 def project_desc(obj):
     """Describe the project configuration"""
+    project = obj['project']
+    header = f'Name: {project.name}\nRepo: {project.repo}\n\n'
+    click.echo(header + _describe(project), nl=False)
+
+
+def _describe(config):
+    """Format the images, workers and builders of a master or project
+
+    The whole description is returned as a single string, so it can be
+    written out at once.
+    """
     def ul(values):
-        return '\n'.join(f' - {v}' for v in values)
+        return '\n'.join([f' - {v}' for v in values])
 
-    project = obj['project']
-    click.echo(f'Name: {project.name}')
-    click.echo(f'Repo: {project.repo}')
-    click.echo()
-    click.echo('Docker images:')
-    click.echo(ul(i.fqn for i in project.images))
-    click.echo()
-    click.echo('Workers:')
-    click.echo(ul(project.workers))
-    click.echo()
-    click.echo('Builders:')
-    click.echo(ul(b.name for b in project.builders))
-    click.echo()
+    return (
+        f'Docker images:\n{ul(i.fqn for i in config.images)}\n\n'
+        f'Workers:\n{ul(config.workers)}\n\n'
+        f'Builders:\n{ul(b.name for b in config.builders)}\n\n'
+    )
 
 
 @ursabot.command()
@@ -232,6 +279,9 @@ def start_master(obj, no_daemon, start_timeout):
     """
     from buildbot.scripts.start import start
 
+    # validate the configuration before touching the running buildmaster
+    config = obj['config']
+
     command_cfg = {
         'basedir': obj['config_path'].parent.absolute(),
         'quiet': False,
@@ -242,7 +292,7 @@ def start_master(obj, no_daemon, start_timeout):
     if result > 0:
         raise click.Abort('Failed to start the Buildbot master!')
 
-    url = obj['config'].url
+    url = config.url
     click.echo('Buildbot UI is available at: ' + click.style(url, fg='green'))
 
 
@@ -288,6 +338,10 @@ def restart_master(obj, no_daemon, start_timeout, clean, no_wait):
     It is a wrapper around `buildbot restart`.
     """
     from buildbot.scripts.restart import restart
+
+    # validate the configuration before touching the running buildmaster
+    config = obj['config']
+
     command_cfg = {
         'basedir': obj['config_path'].parent.absolute(),
         'quiet': False,
@@ -300,10 +354,81 @@ def restart_master(obj, no_daemon, start_timeout, clean, no_wait):
     if result > 0:
         raise click.Abort('Failed to restart the Buildbot master!')
 
-    url = obj['config'].url
+    url = config.url
     click.echo('Buildbot UI is available at: ' + click.style(url, fg='green'))
 
 
+# docker clients keyed by the docker host and the hash of the credentials
+_docker_clients = {}
+
+
+def _docker_client(docker_host, username=None, password=None):
+    """Return a logged in docker client, reusing it within the process"""
+    # hash the credentials to not keep the password around in the key
+    credentials = repr((username, password)).encode()
+    key = (docker_host, hashlib.sha1(credentials).digest())
+    try:
+        return _docker_clients[key]
+    except KeyError:
+        pass
+
+    client = DockerClientWrapper(docker_host)
+    if username is not None:
+        client.login(username=username, password=password)
+
+    _docker_clients[key] = client
+    return client
+
+
+@atexit.register
+def _close_docker_clients():
+    for client in _docker_clients.values():
+        client.close()
+    _docker_clients.clear()
+
+
+def _compile_image_filter(name, tag, variant, no_variant, arch, system,
+                          distro):
+    """Compile the image filtering options to a single predicate
+
+    The semantics are the same as using `Filter` with `Matching` validators,
+    but the wildcard patterns are skipped and the rest are compiled to regular
+    expressions only once instead of per image.
+    """
+    patterns = {
+        'name': name,
+        'tag': tag,
+        'variant': variant,
+        'platform.arch': arch,
+        'platform.system': system,
+        'platform.distro': distro
+    }
+    if no_variant:
+        del patterns['variant']
+
+    checks = [
+        (operator.attrgetter(attr), re.compile(fnmatch.translate(pattern)))
+        for attr, pattern in patterns.items()
+        if pattern != '*'
+    ]
+
+    if no_variant:
+        def check(image):
+            return image.variant is None and all(
+                regex.match(str(getter(image))) for getter, regex in checks
+            )
+    elif checks:
+        def check(image):
+            return all(
+                regex.match(str(getter(image))) for getter, regex in checks
+            )
+    else:
+        def check(image):
+            return True
+
+    return check
+
+
 @ursabot.group()
 @click.option('--docker-host', '-dh', default=None,
               help='Docker host url in form: tcp://127.0.0.1:2375')
@@ -333,31 +458,24 @@ def docker(obj, docker_host, docker_username, docker_password, name, tag,
     MasterConfig aggregates the available docker images from the passed
     projects.
     """
-    config = obj['config']
     if obj['verbose']:
         logging.getLogger('dockermap').setLevel(logging.INFO)
 
-    client = DockerClientWrapper(docker_host)
-    if docker_username is not None:
-        client.login(username=docker_username, password=docker_password)
-
-    if no_variant:
-        variant = None
-
-    image_filter = Filter(
-        name=Matching(name),
-        tag=Matching(tag),
-        variant=Matching(variant),
-        platform=Filter(
-            arch=Matching(arch),
-            system=Matching(system),
-            distro=Matching(distro)
-        )
+    image_filter = _compile_image_filter(
+        name=name,
+        tag=tag,
+        variant=variant,
+        no_variant=no_variant,
+        arch=arch,
+        system=system,
+        distro=distro
     )
-    filtered = ImageCollection(i for i in config.images if image_filter(i))
 
-    obj['client'] = client
-    obj['images'] = filtered
+    # only connect to the docker daemon if the command uses the client
+    obj.lazy('client', lambda: _docker_client(
+        docker_host, username=docker_username, password=docker_password
+    ))
+    obj.lazy('images', lambda: obj['config'].images.filter(image_filter))
 
 
 @docker.command('list')
@@ -375,15 +493,18 @@ def docker_list_images(obj):
               help='Push the built images')
 @click.option('--no-cache/--cache', default=False,
               help='Do not use cache when building the images')
+@click.option('--jobs', '-j', type=click.IntRange(min=1),
+              default=min(8, os.cpu_count() or 1),
+              help='Number of images to build and push concurrently')
 @click.pass_obj
-def docker_image_build(obj, push, no_cache):
+def docker_image_build(obj, push, no_cache, jobs):
     """Build and optionally push docker images"""
     client = obj['client']
     images = obj['images']
 
-    images.build(client=client, nocache=no_cache)
+    images.build(client=client, nocache=no_cache, jobs=jobs)
     if push:
-        images.push(client=client)
+        images.push(client=client, jobs=jobs)
 
 
 @docker.command('write-dockerfiles')
@@ -396,46 +517,77 @@ def docker_write_dockerfiles(obj, directory):
     directory = Path(directory)
     directory.mkdir(parents=True, exist_ok=True)
 
-    for image in images:
-        image.save_dockerfile(directory)
+    # the dockerfiles are small, so write them concurrently, consuming the
+    # results propagates the errors
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda i: i.save_dockerfile(directory), images))
 
 
 def _handle_stdio_log(newlines):
     # 'o': 'stdout',
     # 'e': 'stderr',
     # 'h': 'header'
-    for l in newlines:
-        if l.startswith('h'):
-            click.echo(click.style(l[1:], fg='blue'))
-        elif l.startswith('e'):
-            click.echo(click.style(l[1:], fg='red'))
-        elif l.startswith('o'):
-            click.echo(l[1:])
+    # style the lines first then write them out at once instead of per line
+    lines = []
+    for line in newlines:
+        if line.startswith('h'):
+            lines.append(click.style(line[1:], fg='blue'))
+        elif line.startswith('e'):
+            lines.append(click.style(line[1:], fg='red'))
+        elif line.startswith('o'):
+            lines.append(line[1:])
         else:
-            click.echo(l)
+            lines.append(line)
+
+    if lines:
+        click.echo('\n'.join(lines))
 
 
 def _use_local_sources(builder, sources):
     """Small utility function to inject source volumes"""
-    volumes = []
-    for src, dst in sources.items():
-        src = Path(src).expanduser()
-        volumes.append(
-            util.Interpolate(
-                f'{src}:%(prop:docker_workdir)s/%(prop:builddir)s/{dst}:rw'
-            )
-        )
-
     # add the volumes to the builder
-    builder.volumes.extend(volumes)
+    builder.volumes.extend(
+        util.Interpolate(
+            f'{Path(src).expanduser()}:'
+            f'%(prop:docker_workdir)s/%(prop:builddir)s/{dst}:rw'
+        )
+        for src, dst in sources.items()
+    )
 
     # remove the source steps from the build factory, setting notReally make
-    # the source steps to fake the checkouts
-    from buildbot.steps.source import Source
-    assert hasattr(Source, 'notReally')
+    # the source steps to fake the checkouts, note that it is a class level
+    # flag affecting every source step within the process
     Source.notReally = True
 
 
+@functools.lru_cache(maxsize=None)
+def _install_twisted_observer():
+    """Force twisted logger to use the cli module's python logger
+
+    It is cached to start the observer only once per process, otherwise each
+    twisted log event would be emitted multiple times.
+    """
+    observer = PythonLoggingObserver(loggerName=logger.name)
+    observer.start()
+
+
+def _parse_pairs(values, separator, option, form, from_right=False):
+    """Convert the values of a multiple option to a mapping"""
+    pairs = {}
+    for value in values:
+        if from_right:
+            key, sep, val = value.rpartition(separator)
+        else:
+            key, sep, val = value.partition(separator)
+        if not sep:
+            raise click.UsageError(
+                f'Invalid value `{value}` for option {option}, missing '
+                f'`{separator}`. It must be passed in `{form}` form.'
+            )
+        pairs[key] = val
+    return pairs
+
+
 @project.command('build')
 @click.argument('builder_name', nargs=1)
 @click.option('--repo', '-r', default=None,
@@ -469,9 +621,7 @@ def project_build(obj, builder_name, repo, branch, commit, pull_request,
     sqlite database and triggers the specified builder. The build step logs
     are redirected to the console.
     """
-    # force twisted logger to use the cli module's python logger
-    observer = PythonLoggingObserver(loggerName=logger.name)
-    observer.start()
+    _install_twisted_observer()
 
     config, project = obj['config'], obj['project']
 
@@ -488,9 +638,13 @@ def project_build(obj, builder_name, repo, branch, commit, pull_request,
     else:
         click.echo(f'Triggering builder: {builder}')
 
-    # convert the sources and properties to a plain mapping
-    sources = dict(p.split(':') for p in sources)
-    properties = dict(p.split('=') for p in properties)
+    # convert the sources and properties to a plain mapping, the source
+    # directory may contain colons (e.g. windows drives) unlike the
+    # destination, whereas property values may contain equal signs
+    sources = _parse_pairs(sources, ':', option='--mount-source',
+                           form='source:destination', from_right=True)
+    properties = _parse_pairs(properties, '=', option='--property',
+                              form='name=value')
 
     # if local source directories are passed add them as docker volumes
     if sources:
@@ -512,8 +666,7 @@ def project_build(obj, builder_name, repo, branch, commit, pull_request,
         'project': project.name
     }
 
-    attach_on = {FAILURE, EXCEPTION} if attach_on_failure else set()
-    result = {'complete': False}
+    attach_on = _ATTACH_STATES if attach_on_failure else frozenset()
     try:
         # configure a lightweight master with in-memory database
         master = TestMaster(config, attach_on=attach_on,
@@ -522,25 +675,40 @@ def project_build(obj, builder_name, repo, branch, commit, pull_request,
         raise UrsabotConfigErrors(e)
 
     @ensure_deferred
-    async def run():
+    async def build():
         """Start the master and trigger the requested builders"""
-        nonlocal result
-        try:
-            async with master:
-                result = await master.build(builder.name, sourcestamp,
-                                            properties=properties)
-        finally:
-            reactor.stop()
+        async with master:
+            return await master.build(builder.name, sourcestamp,
+                                      properties=properties)
+
+    # collect either the build's result or the failure, then stop the reactor
+    outcome = []
+
+    def run():
+        d = build()
+        d.addBoth(outcome.append)
+        d.addBoth(lambda _: reactor.stop())
 
     reactor.callWhenRunning(run)
     reactor.run()
 
-    if not result['complete']:
+    # the reactor may have been stopped before the build finished, e.g. by
+    # a keyboard interrupt
+    if not outcome:
+        raise click.ClickException('Build has not completed!')
+
+    result, = outcome
+    if isinstance(result, Failure):
+        logger.error(result.getTraceback())
+        raise click.ClickException(
+            f'Build has not completed: {result.getErrorMessage()}'
+        )
+    elif not result['complete']:
         raise click.ClickException('Build has not completed!')
 
     # 'results' refers to the final state of the build
     state = result['results']
-    if state in (SUCCESS, WARNINGS):
+    if state in _SUCCESS_STATES:
         click.echo(click.style('Build successful!', fg='green'))
     else:
         statestring = Results[state]
@@ -12,6 +12,7 @@ from functools import wraps
 from operator import methodcaller
 from textwrap import indent, dedent
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from toposort import toposort
 from dockermap.api import DockerFile, DockerClientWrapper
@@ -267,21 +268,81 @@ class ImageCollection(list):
                     stack.append(image.base)
         return deps
 
-    def build(self, *args, **kwargs):
+    def build(self, *args, jobs=1, **kwargs):
+        """Build the images including their parents
+
+        Parameters
+        ----------
+        jobs : int, default 1
+            Number of images to build concurrently. An image is only
+            submitted once all of its parents have been built.
+        """
         deps = self._image_dependents()
-        for image_set in toposort(deps):
-            # TODO(kszucs): this can be easily parallelized with dask
-            for image in image_set:
-                image.build(*args, **kwargs)
+        if jobs <= 1:
+            for image_set in toposort(deps):
+                for image in image_set:
+                    image.build(*args, **kwargs)
+            return
+
+        children = collections.defaultdict(set)
+        for image, parents in deps.items():
+            for parent in parents:
+                children[parent].add(image)
+        waiting_for = {image: len(parents) for image, parents in deps.items()}
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            def submit(image):
+                return executor.submit(image.build, *args, **kwargs)
+
+            running = {
+                submit(image): image
+                for image, count in waiting_for.items() if count == 0
+            }
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    image = running.pop(future)
+                    future.result()  # propagate the build errors
+                    for child in children[image]:
+                        waiting_for[child] -= 1
+                        if waiting_for[child] == 0:
+                            running[submit(child)] = child
+
+    def push(self, *args, jobs=1, **kwargs):
+        """Push the images
 
-    def push(self, *args, **kwargs):
+        Parameters
+        ----------
+        jobs : int, default 1
+            Number of images to push concurrently.
+        """
         # topological sort is not required because the layers are cached
-        for image in self:
-            image.push(*args, **kwargs)
+        if jobs <= 1:
+            for image in self:
+                image.push(*args, **kwargs)
+            return
 
-    def filter(self, **kwargs):
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(image.push, *args, **kwargs)
+                       for image in self]
+            for future in futures:
+                future.result()
+
+    def filter(self, predicate=None, **kwargs):
+        """Select the images matching the predicate and the criteria
+
+        Parameters
+        ----------
+        predicate : Callable[[DockerImage], bool], default None
+            Arbitrary function to select the images with.
+        kwargs : dict
+            Attribute criteria, see `ursabot.utils.Filter`.
+        """
         criteria = Filter(**kwargs)
-        filtered = filter(criteria, self)
+        if predicate is None:
+            filtered = [i for i in self if criteria(i)]
+        else:
+            filtered = [i for i in self if predicate(i) and criteria(i)]
         return self.__class__(filtered)
 
 
@@ -0,0 +1,246 @@
+# Copyright 2019 RStudio, Inc.
+# All rights reserved.
+#
+# Use of this source code is governed by a BSD 2-Clause
+# license that can be found in the LICENSE_BSD file.
+
+from textwrap import dedent
+
+import click
+import pytest
+from click.testing import CliRunner
+
+from ursabot.cli import ursabot, LazyContext
+from ursabot.cli import _compile_image_filter, _docker_client, _parse_pairs
+from ursabot.docker import DockerImage, ImageCollection
+from ursabot.utils import Platform, Filter, Matching
+
+
+master_cfg = dedent("""
+    from ursabot.configs import MasterConfig, ProjectConfig
+
+    project = ProjectConfig(
+        name='test',
+        repo='https://github.com/ursa-labs/ursabot'
+    )
+    master = MasterConfig(projects=[project])
+""")
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / 'master.cfg'
+    path.write_text(master_cfg)
+    return path
+
+
+@pytest.fixture
+def images():
+    a = DockerImage(
+        name='a',
+        base='ubuntu:18.04',
+        platform=Platform(distro='ubuntu', arch='amd64', version='18.04'),
+    )
+    b = DockerImage(
+        name='b',
+        base='centos:7',
+        platform=Platform(distro='centos', arch='arm64v8', version='7'),
+    )
+    c = DockerImage('c', base=a)
+    d = DockerImage('d', base=c)
+    e = DockerImage('e', base=c)
+    f = DockerImage('f', base=b)
+    g = DockerImage('g', base=b)
+    h = DockerImage('h', base=g)
+    i = DockerImage('i', base=f)
+    j = DockerImage('j', base=e)
+    k = DockerImage('k', base=e)
+    images = [a, b, c, d, e, f, g, h, i, j, k]
+    conda = [
+        DockerImage(image.name, base=image, tag='conda', variant='conda')
+        for image in [c, e, g]
+    ]
+    return ImageCollection(images + conda)
+
+
+@pytest.mark.parametrize(('options', 'expected'), [
+    (dict(), 'a b c d e f g h i j k c:conda e:conda g:conda'),
+    (dict(no_variant=True), 'a b c d e f g h i j k'),
+    (dict(name='[a-d]'), 'a b c d c:conda'),
+    (dict(name='?', arch='arm*'), 'b f g h i g:conda'),
+    (dict(tag='conda'), 'c:conda e:conda g:conda'),
+    (dict(variant='conda'), 'c:conda e:conda g:conda'),
+    (dict(variant='con*', distro='ubuntu'), 'c:conda e:conda'),
+    (dict(variant='conda', no_variant=True), 'a b c d e f g h i j k'),
+    (dict(arch='amd64', system='linux'), 'a c d e j k c:conda e:conda'),
+    (dict(distro='cent?s', name='h'), 'h'),
+    (dict(distro='debian'), ''),
+])
+def test_compile_image_filter(images, options, expected):
+    defaults = dict(name='*', tag='*', variant='*', no_variant=False,
+                    arch='*', system='*', distro='*')
+    options = dict(defaults, **options)
+
+    # the filter previously constructed by the docker command
+    variant = None if options['no_variant'] else options['variant']
+    reference = Filter(
+        name=Matching(options['name']),
+        tag=Matching(options['tag']),
+        variant=Matching(variant),
+        platform=Filter(
+            arch=Matching(options['arch']),
+            system=Matching(options['system']),
+            distro=Matching(options['distro'])
+        )
+    )
+    predicate = _compile_image_filter(**options)
+
+    filtered = images.filter(predicate)
+    assert filtered == images.filter(reference)
+
+    keys = {
+        f'{i.name}:{i.variant}' if i.variant else i.name for i in filtered
+    }
+    assert keys == set(expected.split())
+
+
+@pytest.mark.parametrize('jobs', ['0', '-2'])
+def test_docker_build_invalid_jobs(config_path, jobs):
+    runner = CliRunner()
+    args = ['-c', str(config_path), 'docker', 'build', '--jobs', jobs]
+    result = runner.invoke(ursabot, args)
+    assert result.exit_code == 2
+    assert 'Invalid value for' in result.output
+    assert '--jobs' in result.output
+
+
+def test_parse_pairs():
+    sources = _parse_pairs(
+        ['/src/arrow:arrow', r'C:\src\ursabot:/dst'], ':',
+        option='--mount-source', form='source:destination', from_right=True
+    )
+    assert sources == {'/src/arrow': 'arrow', r'C:\src\ursabot': '/dst'}
+
+    properties = _parse_pairs(
+        ['a=1', 'b=c=d', 'empty='], '=',
+        option='--property', form='name=value'
+    )
+    assert properties == {'a': '1', 'b': 'c=d', 'empty': ''}
+
+    with pytest.raises(click.UsageError, match='missing `=`'):
+        _parse_pairs(['a=1', 'b'], '=', option='--property', form='name=value')
+    with pytest.raises(click.UsageError, match='--mount-source'):
+        _parse_pairs(['/src'], ':', option='--mount-source',
+                     form='source:destination', from_right=True)
+
+
+def test_project_build_interrupted(tmp_path, monkeypatch):
+    config_path = tmp_path / 'master.cfg'
+    config_path.write_text(dedent("""
+        from ursabot.builders import Builder
+        from ursabot.configs import MasterConfig, ProjectConfig
+        from ursabot.schedulers import AnyBranchScheduler
+        from ursabot.workers import LocalWorker
+
+        worker = LocalWorker('local')
+        builder = Builder(name='echoer', workers=[worker])
+        scheduler = AnyBranchScheduler(name='test', builders=[builder])
+        project = ProjectConfig(
+            name='test',
+            repo='https://github.com/ursa-labs/ursabot',
+            workers=[worker],
+            builders=[builder],
+            schedulers=[scheduler]
+        )
+        master = MasterConfig(projects=[project])
+    """))
+
+    class InterruptedReactor:
+        # stops before the build's deferred would have fired
+
+        def callWhenRunning(self, fn):
+            pass
+
+        def run(self):
+            pass
+
+    monkeypatch.setattr('ursabot.cli.reactor', InterruptedReactor())
+    # don't start the process wide twisted log observer
+    monkeypatch.setattr('ursabot.cli._install_twisted_observer',
+                        lambda: None)
+    args = ['-c', str(config_path), 'project', 'build', 'echoer']
+    result = CliRunner().invoke(ursabot, args)
+    assert result.exit_code == 1
+    assert 'Build has not completed!' in result.output
+
+
+def test_docker_client_credentials(monkeypatch):
+    logins = []
+
+    class DockerClientWrapper:
+
+        def __init__(self, docker_host):
+            self.docker_host = docker_host
+
+        def login(self, username, password):
+            logins.append((username, password))
+
+    monkeypatch.setattr('ursabot.cli.DockerClientWrapper',
+                        DockerClientWrapper)
+    monkeypatch.setattr('ursabot.cli._docker_clients', {})
+
+    host = 'tcp://127.0.0.1:2375'
+    anonymous = _docker_client(host)
+    assert _docker_client(host) is anonymous
+    assert logins == []
+
+    # credentials must not be mistaken for each other
+    first = _docker_client(host, username='a:b', password='c')
+    second = _docker_client(host, username='a', password='b:c')
+    empty = _docker_client(host, username='', password='')
+    assert len({id(anonymous), id(first), id(second), id(empty)}) == 4
+    assert _docker_client(host, username='a:b', password='c') is first
+    assert logins == [('a:b', 'c'), ('a', 'b:c'), ('', '')]
+
+
+def test_lazy_context():
+    calls = []
+
+    def factory():
+        calls.append(None)
+        if len(calls) == 1:
+            raise ValueError('failed')
+        return 'value'
+
+    obj = LazyContext(eager='value')
+    obj.lazy('lazy', factory)
+    assert obj['eager'] == 'value'
+    with pytest.raises(ValueError, match='failed'):
+        obj['lazy']
+    assert obj['lazy'] == 'value'
+    assert obj['lazy'] == 'value'
+    assert len(calls) == 2
+    with pytest.raises(KeyError):
+        obj['missing']
+
+
+def test_passed_context_object(config_path):
+    obj = {'key': 'value'}
+    args = ['-c', str(config_path), 'desc']
+    result = CliRunner().invoke(ursabot, args, obj=obj)
+    assert result.exit_code == 0, result.output
+    assert 'Builders:' in result.output
+
+
+@pytest.mark.parametrize('command', ['start', 'restart'])
+def test_config_is_validated_first(tmp_path, monkeypatch, command):
+    config_path = tmp_path / 'master.cfg'
+    config_path.write_text('raise ValueError("broken")\n')
+
+    called = []
+    monkeypatch.setattr(f'buildbot.scripts.{command}.{command}',
+                        lambda cfg: called.append(cfg) or 0)
+    result = CliRunner().invoke(ursabot, ['-c', str(config_path), command])
+    assert result.exit_code == 1
+    assert 'Configuration Errors' in result.output
+    assert called == []
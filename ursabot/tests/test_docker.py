@@ -204,6 +204,16 @@ def test_image_collection(collection):
     centos_images = [i.name for i in centos_images]
     assert sorted(centos_images) == ['b', 'f', 'g', 'h', 'i']
 
+    derived_images = collection.filter(lambda i: i.name > 'c')
+    assert isinstance(derived_images, ImageCollection)
+    derived_images = [i.name for i in derived_images]
+    assert sorted(derived_images) == ['d', 'e', 'f', 'g', 'h', 'i', 'j', 'k']
+
+    centos_images = collection.filter(lambda i: i.name < 'h',
+                                      platform=Filter(distro='centos'))
+    centos_images = [i.name for i in centos_images]
+    assert sorted(centos_images) == ['b', 'f', 'g']
+
 
 @pytest.mark.docker
 @pytest.mark.integration
@@ -211,6 +221,28 @@ def test_image_collection_build(collection):
     collection.build()
 
 
+@pytest.mark.parametrize('jobs', [0, 1, 4])
+def test_image_collection_build_order(monkeypatch, collection, jobs):
+    built = []
+
+    def build(self, **kwargs):
+        assert kwargs == {'nocache': True}
+        if isinstance(self.base, DockerImage):
+            assert self.base in built
+        built.append(self)
+        return self
+
+    monkeypatch.setattr(DockerImage, 'build', build)
+    collection.build(nocache=True, jobs=jobs)
+    assert len(built) == len(collection)
+    assert set(built) == set(collection)
+
+    pushed = []
+    monkeypatch.setattr(DockerImage, 'push', lambda self: pushed.append(self))
+    collection.push(jobs=jobs)
+    assert set(pushed) == set(collection)
+
+
 def test_readme_example():
     images = ImageCollection()
 